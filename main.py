@@ -1,11 +1,24 @@
-from fastapi import FastAPI, HTTPException, Query
+import os
+
+# yt-dlp desactiva los extractores lazy si esta variable tiene cualquier valor
+os.environ.pop("YTDLP_NO_LAZY_EXTRACTORS", None)
+
+from fastapi import Body, FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 import yt_dlp
 from typing import List, Optional
+import asyncio
+import logging
 import re
+import threading
+import time
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="HiFi Music API")
+app = FastAPI(title="HiFi Music API", default_response_class=ORJSONResponse)
 
 # CORS
 app.add_middleware(
@@ -17,94 +30,317 @@ app.add_middleware(
 )
 
 # Modelos
-class Track(BaseModel):
-    id: str
-    title: str
-    artist: str
-    album: str
-    cover_url: Optional[str]
-    duration: int
-    quality: str = "High"
-
-class SearchResponse(BaseModel):
-    status: str
-    data: dict
-
-class StreamResponse(BaseModel):
-    status: str
-    data: dict
+class SearchRequest(BaseModel):
+    query: str
+
+STREAM_BATCH_MAX_IDS = 50
+
+class StreamBatchRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=STREAM_BATCH_MAX_IDS)
+    quality: str = "high"
+
+# Caché en memoria: clave -> (expira_en, valor)
+# Búsquedas: se sirven tal cual hasta SEARCH_CACHE_TTL; después se sirven
+# obsoletas mientras se refrescan en segundo plano, hasta SEARCH_CACHE_MAX_AGE
+SEARCH_CACHE_TTL = 6 * 60 * 60
+SEARCH_CACHE_MAX_AGE = 24 * 60 * 60
+SEARCH_REFRESH_RETRY = 5 * 60
+TRACK_CACHE_TTL = 5 * 60
+STREAM_CACHE_TTL = 60 * 60
+STREAM_EXPIRY_MARGIN = 60
+# Búsquedas vacías e IDs sin resultado; corto para que los fallos transitorios se recuperen
+NEGATIVE_CACHE_TTL = 5 * 60
+CACHE_MAX_ENTRIES = 10_000
+TRACK_CACHE_MAX_ENTRIES = 1_000
+
+_search_cache: dict = {}
+_track_cache: dict = {}
+_stream_cache: dict = {}
+_negative_cache: dict = {}
+
+# Extracciones en curso, compartidas por peticiones concurrentes con la misma clave
+_inflight_searches: dict = {}
+_inflight_streams: dict = {}
+
+def cache_get(cache: dict, key: str):
+    """Devuelve el valor cacheado o None si no existe o expiró"""
+    item = cache.get(key)
+    if item is None:
+        return None
+    
+    expires_at, value = item
+    if expires_at < time.monotonic():
+        cache.pop(key, None)
+        return None
+    
+    return value
+
+def cache_set(cache: dict, key: str, value, ttl: float,
+              max_entries: int = CACHE_MAX_ENTRIES) -> None:
+    """Guarda un valor con TTL; si está lleno purga lo expirado y, si no basta, lo más antiguo"""
+    if key not in cache and len(cache) >= max_entries:
+        now = time.monotonic()
+        for expired in [k for k, (expires_at, _) in cache.items() if expires_at < now]:
+            del cache[expired]
+        if len(cache) >= max_entries:
+            cache.pop(next(iter(cache)), None)
+    cache[key] = (time.monotonic() + ttl, value)
+
+def single_flight_task(inflight: dict, key: str, make_coro) -> asyncio.Task:
+    """Devuelve la tarea en curso para la clave o lanza make_coro() si no hay ninguna"""
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(make_coro())
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    return task
+
+def single_flight(inflight: dict, key: str, make_coro):
+    """Lanza make_coro() una sola vez por clave y comparte su resultado"""
+    # shield: si un cliente se desconecta no cancela la extracción de los demás
+    return asyncio.shield(single_flight_task(inflight, key, make_coro))
+
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+# Etiquetas que no forman parte del artista: "(Official Video)", "[HD]", "feat. X"...
+_NOISE_RE = re.compile(
+    r'\s*[(\[][^)\]]*\b(?:official|video|audio|lyrics?|hd|hq|4k|visualizer|feat|ft)\b[^)\]]*[)\]]'
+    r'|\s+(?:feat\.|ft\.?|featuring)\s+\w[^-:(\[]*',
+    re.I,
+)
+
+# "Artista - Título", "Artista: Título" o "(Artista)", en ese orden de prioridad
+_ARTIST_RE = re.compile(
+    r'^(?P<dash>[^-]+)\s*-\s*'
+    r'|^(?P<colon>[^:]+)\s*:\s*'
+    r'|\((?P<paren>[^)]+)\)'
+)
+
+# Opciones de yt-dlp
+# Los clientes ios y mweb devuelven URLs que no requieren descifrar la firma con JS
+EXTRACTOR_ARGS = {'youtube': {'player_client': ['ios', 'mweb', 'web']}}
+
+SEARCH_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': 'in_playlist',
+    'extractor_args': EXTRACTOR_ARGS,
+}
+
+TRACK_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extractor_args': EXTRACTOR_ARGS,
+}
+
+STREAM_OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'extractor_args': EXTRACTOR_ARGS,
+}
+
+# YoutubeDL no es thread-safe: una instancia reutilizable por hilo y por opciones.
+# Con requests instalado yt-dlp usa un pool de urllib3 por instancia, así que
+# reutilizarla mantiene vivas las conexiones TLS a youtube.com/googlevideo.com
+_ydl_local = threading.local()
+
+def get_ydl(name: str, opts: dict) -> yt_dlp.YoutubeDL:
+    """Devuelve la instancia de YoutubeDL del hilo actual para estas opciones"""
+    ydl = getattr(_ydl_local, name, None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(opts)
+        setattr(_ydl_local, name, ydl)
+    return ydl
+
+# Límite de llamadas simultáneas a YouTube y reintentos ante 429/503
+YT_MAX_CONCURRENCY = 8
+YT_MAX_RETRIES = 3
+YT_BACKOFF_BASE = 0.5
+YT_COOLDOWN = 30
+
+_yt_semaphore = asyncio.Semaphore(YT_MAX_CONCURRENCY)
+_yt_cooldown_until = 0.0
+
+class YouTubeRateLimited(Exception):
+    """YouTube está limitando las peticiones (429/503 o periodo de espera activo)"""
+
+def is_rate_limited(error: Exception) -> bool:
+    """Indica si el error de yt-dlp es un bloqueo temporal de YouTube"""
+    message = str(error)
+    return 'HTTP Error 429' in message or 'HTTP Error 503' in message
+
+def extract_info(name: str, opts: dict, target: str) -> dict:
+    """Ejecuta extract_info con backoff exponencial ante 429/503"""
+    global _yt_cooldown_until
+    
+    # Tras agotar los reintentos no se vuelve a llamar a YouTube durante YT_COOLDOWN
+    if time.monotonic() < _yt_cooldown_until:
+        raise YouTubeRateLimited("YouTube rate limited, cooling down")
+    
+    ydl = get_ydl(name, opts)
+    for attempt in range(YT_MAX_RETRIES):
+        try:
+            return ydl.extract_info(target, download=False)
+        except yt_dlp.utils.DownloadError as e:
+            if not is_rate_limited(e):
+                raise
+            if attempt == YT_MAX_RETRIES - 1:
+                _yt_cooldown_until = time.monotonic() + YT_COOLDOWN
+                raise YouTubeRateLimited(str(e)) from e
+            time.sleep(YT_BACKOFF_BASE * 2 ** attempt)
+
+async def run_yt(func, *args):
+    """Ejecuta una función bloqueante de yt-dlp en un hilo, limitando la concurrencia"""
+    async with _yt_semaphore:
+        return await asyncio.to_thread(func, *args)
 
 # Función para buscar en YouTube
 def search_youtube(query: str, max_results: int = 20) -> List[dict]:
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': True,
-        'format': 'bestaudio/best',
-    }
-    
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            result = ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
-            
-            tracks = []
-            for entry in result.get('entries', []):
-                if entry:
-                    tracks.append({
-                        'id': entry.get('id'),
-                        'title': entry.get('title', 'Unknown'),
-                        'artist': extract_artist(entry.get('title', '')),
-                        'album': entry.get('album', 'Unknown'),
-                        'cover_url': entry.get('thumbnail'),
-                        'duration': (entry.get('duration', 0) or 0) * 1000,
-                        'quality': 'High',
-                    })
-            
-            return tracks
-    except Exception as e:
-        print(f"Error searching YouTube: {e}")
+        result = extract_info('search', SEARCH_OPTS, f"ytsearch{max_results}:{query}")
+        
+        tracks = []
+        for entry in result.get('entries', []):
+            if entry:
+                tracks.append({
+                    'id': entry.get('id'),
+                    'title': entry.get('title', 'Unknown'),
+                    'artist': extract_artist(entry.get('title', '')),
+                    'album': entry.get('album', 'Unknown'),
+                    'cover_url': entry.get('thumbnail'),
+                    'duration': (entry.get('duration', 0) or 0) * 1000,
+                    'quality': 'High',
+                })
+        
+        return tracks
+    except YouTubeRateLimited:
+        raise
+    except Exception:
+        logger.warning("Error searching YouTube: %r", query, exc_info=True)
         return []
 
 def extract_artist(title: str) -> str:
     """Extrae el artista del título de YouTube"""
-    patterns = [
-        r'^([^-]+)\s*-\s*',
-        r'^([^:]+)\s*:\s*',
-        r'\(([^)]+)\)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, title)
-        if match:
-            return match.group(1).strip()
+    match = _ARTIST_RE.search(_NOISE_RE.sub('', title))
+    if match:
+        return (match.group('dash') or match.group('colon') or match.group('paren')).strip()
     
     return "Unknown Artist"
 
 def get_stream_url(video_id: str, quality: str = "high") -> Optional[str]:
     """Obtiene URL de streaming directa"""
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'no_warnings': True,
-    }
-    
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
-            
-            formats = info.get('formats', [])
-            audio_formats = [f for f in formats if f.get('acodec') != 'none']
-            
-            if audio_formats:
-                best_audio = max(audio_formats, key=lambda x: x.get('abr', 0))
-                return best_audio.get('url')
-            
-            return info.get('url')
-    except Exception as e:
-        print(f"Error getting stream URL: {e}")
+        info = extract_info('stream', STREAM_OPTS, f"https://www.youtube.com/watch?v={video_id}")
+        
+        # Una sola pasada: el formato solo-audio con mayor bitrate
+        best_audio = None
+        best_abr = -1
+        for f in info.get('formats') or ():
+            if f.get('vcodec') != 'none' or f.get('acodec') == 'none':
+                continue
+            abr = f.get('abr') or 0
+            if abr > best_abr:
+                best_audio, best_abr = f, abr
+        
+        return (best_audio or info).get('url')
+    except YouTubeRateLimited:
+        raise
+    except Exception:
+        logger.warning("Error getting stream URL: %s", video_id, exc_info=True)
         return None
 
+def get_track_info(video_id: str) -> dict:
+    """Obtiene los metadatos completos de un video"""
+    return extract_info('track', TRACK_OPTS, f"https://www.youtube.com/watch?v={video_id}")
+
+def parse_expiry(url: str) -> Optional[int]:
+    """Extrae el timestamp de expiración de una URL firmada de googlevideo"""
+    match = _EXPIRE_RE.search(url)
+    return int(match.group(1)) if match else None
+
+async def resolve_stream_url(video_id: str, quality: str, key: str) -> tuple:
+    """Extrae la URL de streaming y la guarda en caché"""
+    url = await run_yt(get_stream_url, video_id, quality)
+    if not url:
+        cache_set(_negative_cache, f"stream:{key}", True, NEGATIVE_CACHE_TTL)
+        return None, None
+    
+    expires_at = parse_expiry(url)
+    ttl = STREAM_CACHE_TTL
+    if expires_at is not None:
+        ttl = expires_at - time.time() - STREAM_EXPIRY_MARGIN
+    if ttl > 0:
+        cache_set(_stream_cache, key, (url, expires_at), ttl)
+    return url, expires_at
+
+async def fetch_stream_url(video_id: str, quality: str) -> tuple:
+    """Obtiene (url, expires_at) de streaming pasando por la caché"""
+    key = f"{video_id}:{quality}"
+    cached = cache_get(_stream_cache, key)
+    if cached is not None:
+        return cached
+    if cache_get(_negative_cache, f"stream:{key}"):
+        return None, None
+    
+    return await single_flight(
+        _inflight_streams, key, lambda: resolve_stream_url(video_id, quality, key)
+    )
+
+def keep_stale_search(key: str) -> bool:
+    """Tras un refresco fallido conserva el resultado obsoleto, si lo hay"""
+    stale = _search_cache.get(key)
+    if stale is None:
+        return False
+    
+    # Se mantiene su expiración y no se reintenta hasta pasados SEARCH_REFRESH_RETRY
+    expires_at, (_, stale_tracks) = stale
+    retry_at = time.monotonic() - SEARCH_CACHE_TTL + SEARCH_REFRESH_RETRY
+    _search_cache[key] = (expires_at, (retry_at, stale_tracks))
+    return True
+
+async def resolve_search(query: str, key: str) -> List[dict]:
+    """Busca en YouTube y guarda el resultado en caché"""
+    try:
+        tracks = await run_yt(search_youtube, query)
+    except YouTubeRateLimited:
+        # Un bloqueo temporal no es un resultado vacío: no va a la caché negativa
+        if keep_stale_search(key):
+            return []
+        raise
+    
+    if tracks:
+        cache_set(_search_cache, key, (time.monotonic(), tracks), SEARCH_CACHE_MAX_AGE)
+    elif not keep_stale_search(key):
+        cache_set(_negative_cache, f"search:{key}", True, NEGATIVE_CACHE_TTL)
+    return tracks
+
+async def fetch_search(query: str) -> List[dict]:
+    """Busca canciones pasando por la caché (stale-while-revalidate)"""
+    key = query.lower().strip()
+    cached = cache_get(_search_cache, key)
+    if cached is not None:
+        refreshed_at, tracks = cached
+        if time.monotonic() - refreshed_at > SEARCH_CACHE_TTL:
+            single_flight_task(_inflight_searches, key, lambda: resolve_search(query, key))
+        return tracks
+    if cache_get(_negative_cache, f"search:{key}"):
+        return []
+    
+    # Evita la estampida cuando expira una búsqueda popular
+    return await single_flight(_inflight_searches, key, lambda: resolve_search(query, key))
+
 # Endpoints
+# yt-dlp es bloqueante: run_yt lo ejecuta en un hilo para no detener el event loop.
+# Las respuestas se devuelven ya serializadas con orjson para saltarse jsonable_encoder
+@app.exception_handler(YouTubeRateLimited)
+async def rate_limited_handler(request, exc: YouTubeRateLimited):
+    return ORJSONResponse(
+        status_code=503,
+        content={"detail": "YouTube is rate limiting requests, try again later"},
+        headers={"Retry-After": str(YT_COOLDOWN)},
+    )
+
 @app.get("/")
 def root():
     return {
@@ -113,50 +349,64 @@ def root():
         "status": "running"
     }
 
-@app.get("/api/search")
+@app.api_route("/api/search", methods=["GET", "POST"])
 async def search(
-    q: str = Query(..., description="Search query"),
-    type: str = Query("tracks", description="Search type")
+    q: Optional[str] = Query(None, description="Search query"),
+    type: str = Query("tracks", description="Search type"),
+    body: Optional[SearchRequest] = Body(None)
 ):
-    """Buscar música - GET METHOD"""
-    if not q:
-        raise HTTPException(status_code=400, detail="Query parameter 'q' is required")
+    """Buscar música - GET con ?q= o POST con {"query": ...}"""
+    query = q or (body.query if body else None)
+    if not query:
+        raise HTTPException(
+            status_code=400, detail="Query parameter 'q' or body field 'query' is required"
+        )
     
-    tracks = search_youtube(q)
+    tracks = await fetch_search(query)
     
-    return {
+    return ORJSONResponse({
         "status": "success",
         "data": {
             "tracks": tracks,
             "artists": [],
             "albums": []
         }
-    }
+    })
 
 @app.get("/api/track/{track_id}")
 async def get_track(track_id: str):
     """Obtener detalles de una canción"""
-    try:
-        ydl_opts = {'quiet': True, 'no_warnings': True}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(f"https://www.youtube.com/watch?v={track_id}", download=False)
-            
-            return {
-                "status": "success",
-                "data": {
-                    "id": track_id,
-                    "title": info.get('title'),
-                    "artist": extract_artist(info.get('title', '')),
-                    "album": info.get('album', 'Unknown'),
-                    "cover_url": info.get('thumbnail'),
-                    "duration": (info.get('duration', 0) or 0) * 1000,
-                    "quality": "High",
-                    "bitrate": f"{info.get('abr', 128)} kbps",
-                    "sample_rate": "44.1 kHz"
-                }
-            }
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=str(e))
+    if cache_get(_negative_cache, f"track:{track_id}"):
+        raise HTTPException(status_code=404, detail="Track not found")
+    
+    # Solo se cachea la respuesta: el dict de extract_info completo ocupa cientos de KB
+    data = cache_get(_track_cache, track_id)
+    if data is None:
+        try:
+            info = await run_yt(get_track_info, track_id)
+        except YouTubeRateLimited:
+            raise
+        except Exception as e:
+            cache_set(_negative_cache, f"track:{track_id}", True, NEGATIVE_CACHE_TTL)
+            raise HTTPException(status_code=404, detail=str(e))
+        
+        data = {
+            "id": track_id,
+            "title": info.get('title'),
+            "artist": extract_artist(info.get('title', '')),
+            "album": info.get('album', 'Unknown'),
+            "cover_url": info.get('thumbnail'),
+            "duration": (info.get('duration', 0) or 0) * 1000,
+            "quality": "High",
+            "bitrate": f"{info.get('abr', 128)} kbps",
+            "sample_rate": "44.1 kHz"
+        }
+        cache_set(_track_cache, track_id, data, TRACK_CACHE_TTL, TRACK_CACHE_MAX_ENTRIES)
+    
+    return ORJSONResponse({
+        "status": "success",
+        "data": data
+    })
 
 @app.get("/api/stream/{track_id}")
 async def get_stream(
@@ -164,19 +414,42 @@ async def get_stream(
     quality: str = Query("high", description="Audio quality")
 ):
     """Obtener URL de streaming"""
-    url = get_stream_url(track_id, quality)
+    url, expires_at = await fetch_stream_url(track_id, quality)
     
     if not url:
         raise HTTPException(status_code=404, detail="Stream URL not found")
     
-    return {
+    return ORJSONResponse({
         "status": "success",
         "data": {
             "stream_url": url,
             "quality": quality,
-            "expires_at": None
+            "expires_at": expires_at
         }
-    }
+    })
+
+@app.post("/api/stream/batch")
+async def get_stream_batch(request: StreamBatchRequest):
+    """Obtener URLs de streaming de varias canciones"""
+    ids = list(dict.fromkeys(request.ids))
+    results = await asyncio.gather(
+        *(fetch_stream_url(track_id, request.quality) for track_id in ids)
+    )
+    
+    return ORJSONResponse({
+        "status": "success",
+        "data": {
+            "streams": [
+                {
+                    "id": track_id,
+                    "stream_url": url,
+                    "quality": request.quality,
+                    "expires_at": expires_at
+                }
+                for track_id, (url, expires_at) in zip(ids, results)
+            ]
+        }
+    })
 
 @app.get("/api/download/{track_id}")
 async def get_download(
@@ -184,21 +457,29 @@ async def get_download(
     quality: str = Query("high", description="Audio quality")
 ):
     """Obtener URL de descarga"""
-    url = get_stream_url(track_id, quality)
+    url, expires_at = await fetch_stream_url(track_id, quality)
     
     if not url:
         raise HTTPException(status_code=404, detail="Download URL not found")
     
-    return {
+    return ORJSONResponse({
         "status": "success",
         "data": {
             "download_url": url,
             "quality": quality,
             "file_size": None,
-            "expires_at": None
+            "expires_at": expires_at
         }
-    }
+    })
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+    )
\ No newline at end of file